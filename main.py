@@ -3,20 +3,37 @@ Microserviço de transcrição do YouTube
 FastAPI + youtube-transcript-api
 """
 import os
-import uuid
+import hmac
+import time
+import hashlib
+import asyncio
 import logging
+import itertools
+import threading
+from collections import OrderedDict
 from typing import Optional
-from datetime import datetime, timedelta
 
-from fastapi import FastAPI, HTTPException, Header, Query, Request
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from fastapi import Depends, FastAPI, HTTPException, Header, Query, Request
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from youtube_transcript_api import YouTubeTranscriptApi
+from youtube_transcript_api._transcripts import TranscriptListFetcher
 from youtube_transcript_api._errors import (
     TranscriptsDisabled,
     NoTranscriptFound,
+    NotTranslatable,
+    TranslationLanguageNotAvailable,
     VideoUnavailable,
     TooManyRequests,
 )
+from tenacity import (
+    retry,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 
 # Configuração de logging
 logging.basicConfig(
@@ -27,26 +44,63 @@ logger = logging.getLogger(__name__)
 
 # Configurações do ambiente
 API_KEY = os.getenv("API_KEY", "").strip()
+_API_KEY_BYTES = API_KEY.encode()
 CORS_ORIGINS = os.getenv("CORS_ORIGINS", "*").strip()
 CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", "3600"))
+MAX_CONCURRENT_YT = int(os.getenv("MAX_CONCURRENT_YT", "8"))
 PORT = int(os.getenv("PORT", "8000"))
 
-# Cache simples em memória
-cache: dict = {}
+# Idiomas de fallback quando o cliente não especifica `lang`
+_DEFAULT_LANGS = ("pt-BR", "pt", "pt-PT", "en")
+_DEFAULT_LANGS_JOINED = ",".join(_DEFAULT_LANGS)
+
+# Gerador de request_id: pid + contador monotônico é suficiente para
+# rastreio e evita um os.urandom(16) + formatação de UUID por requisição
+_pid = os.getpid()
+_req_counter = itertools.count()
+
+
+def _new_request_id() -> str:
+    return f"{_pid:x}-{next(_req_counter):x}"
+
+# Cache LRU simples em memória (mais recente no final do OrderedDict).
+# O lock protege move_to_end/popitem, que não são atômicos, caso os
+# helpers sejam chamados fora do event loop (threadpool)
+cache: "OrderedDict[str, dict]" = OrderedDict()
 CACHE_MAX_SIZE = 256
+_cache_lock = threading.Lock()
+
+# Buscas upstream em andamento (singleflight): requisições concorrentes
+# para o mesmo video:lang compartilham uma única busca no YouTube
+inflight: "dict[str, asyncio.Future]" = {}
+
+# Sessão HTTP compartilhada com pool de conexões (keep-alive com o YouTube)
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=0))
+_session.headers["User-Agent"] = "Mozilla/5.0 (compatible; yt-transcript/1.0)"
+_transcript_fetcher = TranscriptListFetcher(_session)
+
+# Limite global de buscas simultâneas no YouTube
+_yt_semaphore = asyncio.Semaphore(MAX_CONCURRENT_YT)
 
 app = FastAPI(
     title="YouTube Transcript API",
     description="Microserviço para obter transcrições de vídeos do YouTube",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
-# CORS
-cors_origins = CORS_ORIGINS.split(",") if CORS_ORIGINS != "*" else ["*"]
+# CORS: navegadores rejeitam allow_credentials junto com origem "*",
+# então credenciais só são permitidas com origens explícitas
+if CORS_ORIGINS == "*":
+    cors_origins, cors_credentials = ["*"], False
+else:
+    cors_origins = [o.strip() for o in CORS_ORIGINS.split(",") if o.strip()]
+    cors_credentials = True
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=cors_origins if CORS_ORIGINS != "*" else ["*"],
-    allow_credentials=True,
+    allow_origins=cors_origins,
+    allow_credentials=cors_credentials,
     allow_methods=["*"],
     allow_headers=["*"],
 )
@@ -57,50 +111,145 @@ def get_cache_key(video_id: str, lang: str) -> str:
     return f"{video_id}:{lang}"
 
 
+def _make_etag(body: bytes) -> str:
+    """ETag fraco (hash curto do corpo serializado)"""
+    return f'W/"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+
+
 def get_from_cache(key: str) -> Optional[dict]:
-    """Recupera do cache se ainda válido"""
-    if key not in cache:
-        return None
-    
-    entry = cache[key]
-    if datetime.now() > entry["expires_at"]:
-        del cache[key]
-        return None
-    
-    return entry["data"]
+    """Recupera a entrada do cache (dados + corpo serializado) se ainda válida"""
+    with _cache_lock:
+        entry = cache.get(key)
+        if entry is None:
+            return None
 
+        if time.monotonic() > entry["expires_at"]:
+            del cache[key]
+            return None
 
-def set_cache(key: str, data: dict):
-    """Armazena no cache com TTL"""
-    # Limpar cache se exceder tamanho máximo (LRU simples)
-    if len(cache) >= CACHE_MAX_SIZE:
-        # Remove a entrada mais antiga
-        oldest_key = min(cache.keys(), key=lambda k: cache[k]["expires_at"])
-        del cache[oldest_key]
-    
-    cache[key] = {
+        # Marca como usado recentemente (LRU)
+        cache.move_to_end(key)
+        return entry
+
+
+def set_cache(key: str, data: dict, alias_key: Optional[str] = None):
+    """Armazena no cache com TTL, já com o corpo JSON serializado
+
+    Serializar uma única vez aqui evita re-encodar a lista de segmentos
+    (o maior custo de CPU) em cada cache hit. `alias_key` registra uma
+    segunda chave apontando para a mesma entrada.
+    """
+    # O corpo completo só existe quando a busca montou os segmentos; uma
+    # entrada criada por uma requisição format=text fica com o slot "json"
+    # vazio até uma requisição json preenchê-lo
+    json_body = orjson.dumps(data) if "segments" in data else None
+    text_body = orjson.dumps({"video_id": data["video_id"], "text": data["text"]})
+
+    # ETags calculados uma única vez por entrada, para responder 304 a
+    # clientes que reenviam If-None-Match
+    entry = {
         "data": data,
-        "expires_at": datetime.now() + timedelta(seconds=CACHE_TTL_SECONDS)
+        "json": json_body,
+        "etag": _make_etag(json_body) if json_body is not None else None,
+        "text_json": text_body,
+        "text_etag": _make_etag(text_body),
+        "expires_at": time.monotonic() + CACHE_TTL_SECONDS
     }
 
+    # Serialização fica fora do lock; a seção crítica é só a mutação O(1)
+    with _cache_lock:
+        cache[key] = entry
+        cache.move_to_end(key)
+        if alias_key is not None and alias_key != key:
+            cache[alias_key] = entry
+            cache.move_to_end(alias_key)
+
+        # Descarta as entradas menos usadas recentemente em O(1)
+        while len(cache) > CACHE_MAX_SIZE:
+            cache.popitem(last=False)
+
+
+@retry(
+    retry=retry_if_exception_type(TooManyRequests),
+    wait=wait_random_exponential(min=1, max=8),
+    stop=stop_after_attempt(3),
+    reraise=True,
+)
+def _blocking_fetch(video_id: str, languages: tuple, request_id: str) -> tuple:
+    """Busca a transcrição de forma síncrona (executada fora do event loop)
+
+    Rate limits transitórios do YouTube são retentados com backoff
+    exponencial antes de propagar TooManyRequests ao cliente.
+    """
+    transcript_list = _transcript_fetcher.fetch(video_id)
+
+    # find_transcript já percorre os idiomas em ordem de preferência em
+    # uma única passada, então não há por que chamá-lo uma vez por idioma
+    try:
+        transcript = transcript_list.find_transcript(list(languages))
+        language_used = transcript.language_code
+    except NoTranscriptFound:
+        # Fallback: primeira transcrição disponível, traduzida para o
+        # idioma preferido quando possível
+        try:
+            transcript = next(iter(transcript_list))
+        except StopIteration:
+            logger.warning("Request %s: No transcripts available for video %s", request_id, video_id)
+            raise NoTranscriptFound(video_id, languages, None)
+
+        try:
+            transcript = transcript.translate(languages[0])
+            language_used = languages[0]
+        except (NotTranslatable, TranslationLanguageNotAvailable):
+            language_used = transcript.language_code
+
+    return transcript.fetch(), language_used
+
+
+async def _run_fetch(flight_key: str, fut: "asyncio.Future", video_id: str,
+                     languages: tuple, request_id: str):
+    """Executa a busca upstream e resolve o future compartilhado
+
+    Roda em uma task própria, desacoplada da requisição que a iniciou:
+    se o cliente líder desconectar, as demais requisições aguardando o
+    mesmo future continuam sendo atendidas normalmente.
+    """
+    try:
+        # Executa as chamadas bloqueantes no threadpool padrão,
+        # respeitando o limite global de concorrência com o YouTube
+        async with _yt_semaphore:
+            result = await asyncio.to_thread(_blocking_fetch, video_id, languages, request_id)
+    except BaseException as exc:
+        fut.set_exception(exc)
+        fut.exception()  # evita warning se nenhuma requisição estiver aguardando
+    else:
+        fut.set_result(result)
+    finally:
+        inflight.pop(flight_key, None)
 
-def verify_api_key(x_api_key: Optional[str] = Header(None, alias="x-api-key")):
-    """Middleware para verificar API Key se configurada"""
-    if API_KEY:
-        if not x_api_key or x_api_key != API_KEY:
-            raise HTTPException(
-                status_code=401,
-                detail={"error": "unauthorized"}
-            )
+
+def verify_api_key(request: Request, x_api_key: Optional[str] = Header(None, alias="x-api-key")):
+    """Dependência que verifica a API Key, se configurada
+
+    Usa comparação em tempo constante para não vazar o tamanho/prefixo
+    da chave via timing.
+    """
+    if API_KEY and not hmac.compare_digest((x_api_key or "").encode(), _API_KEY_BYTES):
+        request_id = getattr(request.state, "request_id", "-")
+        logger.warning("Request %s: Unauthorized access attempt", request_id)
+        raise HTTPException(
+            status_code=401,
+            detail={"error": "unauthorized"}
+        )
 
 
 @app.middleware("http")
 async def add_request_id(request: Request, call_next):
     """Adiciona request_id a cada requisição"""
-    request_id = str(uuid.uuid4())
+    request_id = _new_request_id()
     request.state.request_id = request_id
     
-    logger.info(f"Request {request_id}: {request.method} {request.url.path}")
+    logger.info("Request %s: %s %s", request_id, request.method, request.url.path)
     
     response = await call_next(request)
     response.headers["X-Request-Id"] = request_id
@@ -123,7 +272,7 @@ async def get_transcript(
     video_id: str,
     lang: Optional[str] = Query(None, description="Idioma preferencial (ex: pt-BR, pt, en)"),
     format: str = Query("json", description="Formato de resposta: 'text' ou 'json'"),
-    x_api_key: Optional[str] = Header(None, alias="x-api-key")
+    _: None = Depends(verify_api_key)
 ):
     """
     Obtém transcrição de um vídeo do YouTube
@@ -132,17 +281,8 @@ async def get_transcript(
     - **lang**: Idioma preferencial (padrão: pt-BR, pt, pt-PT, en)
     - **format**: 'text' para apenas texto, 'json' para texto + segmentos
     """
-    request_id = getattr(request.state, "request_id", str(uuid.uuid4()))
-    
-    # Verificar API Key se configurada
-    if API_KEY:
-        if not x_api_key or x_api_key != API_KEY:
-            logger.warning(f"Request {request_id}: Unauthorized access attempt")
-            raise HTTPException(
-                status_code=401,
-                detail={"error": "unauthorized"}
-            )
-    
+    request_id = getattr(request.state, "request_id", None) or _new_request_id()
+
     # Validar formato
     if format not in ["text", "json"]:
         raise HTTPException(
@@ -150,96 +290,106 @@ async def get_transcript(
             detail={"error": "invalid_format", "message": "Formato deve ser 'text' ou 'json'"}
         )
     
-    # Determinar idiomas a tentar
-    if lang:
-        languages = [lang]
-    else:
-        languages = ["pt-BR", "pt", "pt-PT", "en"]
-    
+    # Determinar idiomas a tentar (tupla: nenhuma alocação no caso padrão)
+    languages = (lang,) if lang else _DEFAULT_LANGS
+
     # Verificar cache
-    cache_key = get_cache_key(video_id, ",".join(languages))
-    cached_result = get_from_cache(cache_key)
-    if cached_result:
-        logger.info(f"Request {request_id}: Cache hit for video {video_id}")
-        result = cached_result.copy()
-        result["request_id"] = request_id
-        
-        # Ajustar formato se necessário
+    # O cache é indexado pelo idioma efetivamente resolvido, então basta
+    # sondar cada idioma candidato — pedidos com listas de preferência
+    # diferentes reaproveitam a mesma entrada
+    cached_entry = None
+    for candidate_lang in languages:
+        cached_entry = get_from_cache(get_cache_key(video_id, candidate_lang))
+        if cached_entry:
+            break
+    if cached_entry:
+        # Corpo pré-serializado: nenhum json.dumps nem cópia de dict no
+        # caminho de hit (o request_id segue no header X-Request-Id)
         if format == "text":
-            return {
-                "video_id": result["video_id"],
-                "text": result["text"],
-                "request_id": request_id
-            }
-        return result
+            body, etag = cached_entry["text_json"], cached_entry["text_etag"]
+        else:
+            body, etag = cached_entry["json"], cached_entry["etag"]
+        if body is not None:
+            logger.info("Request %s: Cache hit for video %s", request_id, video_id)
+            # Cliente já tem este corpo? 304 sem payload
+            if request.headers.get("if-none-match") == etag:
+                return Response(status_code=304, headers={"ETag": etag})
+            return Response(content=body, media_type="application/json", headers={"ETag": etag})
+        # Entrada criada por uma requisição format=text: não tem os
+        # segmentos, então segue para a busca e preenche o slot "json"
     
+    # Cliente já desconectou? Não vale a pena iniciar a busca upstream
+    if await request.is_disconnected():
+        logger.info("Request %s: Client disconnected before fetch for video %s", request_id, video_id)
+        return Response(status_code=204)
+
     # Buscar transcrição
     try:
-        logger.info(f"Request {request_id}: Fetching transcript for video {video_id} with languages {languages}")
-        
-        transcript_data = None
-        language_used = None
-        
-        # Tentar obter transcrição diretamente nos idiomas preferidos
-        for preferred_lang in languages:
-            try:
-                transcript_data = YouTubeTranscriptApi.get_transcript(video_id, languages=[preferred_lang])
-                language_used = preferred_lang
-                break
-            except (NoTranscriptFound, TranscriptsDisabled):
-                continue
-            except Exception as e:
-                logger.warning(f"Request {request_id}: Error getting transcript in {preferred_lang}: {str(e)}")
-                continue
-        
-        # Se não encontrou, tentar sem especificar idioma (pega qualquer disponível)
-        if not transcript_data:
-            try:
-                transcript_data = YouTubeTranscriptApi.get_transcript(video_id)
-                language_used = "auto"
-            except Exception as e:
-                logger.warning(f"Request {request_id}: Error getting transcript without language: {str(e)}")
-                raise NoTranscriptFound(video_id, languages, None)
-        
+        logger.info("Request %s: Fetching transcript for video %s with languages %s", request_id, video_id, languages)
+
+        # Singleflight: requisições concorrentes compartilham a mesma busca
+        # (chave no formato pedido, já que o idioma resolvido ainda não é conhecido)
+        flight_key = get_cache_key(video_id, lang if lang else _DEFAULT_LANGS_JOINED)
+        fut = inflight.get(flight_key)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            inflight[flight_key] = fut
+            asyncio.create_task(_run_fetch(flight_key, fut, video_id, languages, request_id))
+        else:
+            logger.info("Request %s: Awaiting in-flight fetch for video %s", request_id, video_id)
+
+        # shield: cancelar esta requisição não cancela a busca que as
+        # demais requisições do mesmo voo estão aguardando
+        transcript_data, language_used = await asyncio.shield(fut)
+
         # Montar texto completo
-        full_text = " ".join([item["text"] for item in transcript_data])
+        full_text = " ".join(item["text"] for item in transcript_data)
         
-        # Preparar resposta
+        # Preparar resposta (sem request_id: a entrada vai para o cache
+        # e é compartilhada entre requisições)
         result = {
             "video_id": video_id,
             "text": full_text,
             "language_used": language_used or "unknown",
-            "request_id": request_id
         }
         
         if format == "json":
             # Formatar segmentos
-            segments = []
-            for item in transcript_data:
-                segments.append({
+            result["segments"] = [
+                {
                     "text": item["text"],
                     "start": item["start"],
                     "duration": item.get("duration", 0)
-                })
-            result["segments"] = segments
+                }
+                for item in transcript_data
+            ]
         
-        # Armazenar no cache
-        set_cache(cache_key, result)
+        # Armazenar no cache sob o idioma resolvido (uma entrada por
+        # vídeo/idioma, independente da lista de preferência do cliente).
+        # Se o fallback resolveu um idioma fora da lista pedida, as sondas
+        # de leitura nunca o encontrariam — um alias sob o primeiro
+        # candidato mantém a entrada alcançável
+        alias_key = (
+            get_cache_key(video_id, languages[0])
+            if language_used not in languages else None
+        )
+        set_cache(get_cache_key(video_id, language_used), result, alias_key)
         
-        logger.info(f"Request {request_id}: Successfully fetched transcript for video {video_id}")
+        logger.info("Request %s: Successfully fetched transcript for video %s", request_id, video_id)
         
-        # Retornar conforme formato solicitado
+        # Retornar conforme formato solicitado. ORJSONResponse direto
+        # pula o jsonable_encoder/validação do FastAPI sobre o payload;
+        # o request_id vai só no header X-Request-Id (via middleware)
         if format == "text":
-            return {
+            return ORJSONResponse({
                 "video_id": result["video_id"],
-                "text": result["text"],
-                "request_id": request_id
-            }
-        
-        return result
+                "text": result["text"]
+            })
+
+        return ORJSONResponse(result)
         
     except TranscriptsDisabled:
-        logger.warning(f"Request {request_id}: Transcripts disabled for video {video_id}")
+        logger.warning("Request %s: Transcripts disabled for video %s", request_id, video_id)
         raise HTTPException(
             status_code=404,
             detail={
@@ -249,7 +399,7 @@ async def get_transcript(
             }
         )
     except NoTranscriptFound:
-        logger.warning(f"Request {request_id}: No transcript found for video {video_id}")
+        logger.warning("Request %s: No transcript found for video %s", request_id, video_id)
         raise HTTPException(
             status_code=404,
             detail={
@@ -259,7 +409,7 @@ async def get_transcript(
             }
         )
     except VideoUnavailable:
-        logger.warning(f"Request {request_id}: Video unavailable: {video_id}")
+        logger.warning("Request %s: Video unavailable: %s", request_id, video_id)
         raise HTTPException(
             status_code=404,
             detail={
@@ -269,7 +419,7 @@ async def get_transcript(
             }
         )
     except TooManyRequests:
-        logger.error(f"Request {request_id}: Rate limited for video {video_id}")
+        logger.error("Request %s: Rate limited for video %s", request_id, video_id)
         raise HTTPException(
             status_code=429,
             detail={
@@ -284,7 +434,7 @@ async def get_transcript(
         
         # Tratar erros específicos de parsing XML/HTML
         if "no element found" in error_msg.lower() or "xml" in error_msg.lower():
-            logger.error(f"Request {request_id}: XML parsing error for video {video_id}: {error_msg}")
+            logger.error("Request %s: XML parsing error for video %s: %s", request_id, video_id, error_msg)
             raise HTTPException(
                 status_code=404,
                 detail={
@@ -294,7 +444,7 @@ async def get_transcript(
                 }
             )
         
-        logger.error(f"Request {request_id}: Internal error for video {video_id} ({error_type}): {error_msg}", exc_info=True)
+        logger.error("Request %s: Internal error for video %s (%s): %s", request_id, video_id, error_type, error_msg, exc_info=True)
         raise HTTPException(
             status_code=500,
             detail={